@@ -591,6 +591,10 @@ class Config(UTF8Class):
             default=FORMAT_PLAIN,
             choices=[FORMAT_PLAIN, FORMAT_JSON, FORMAT_JUNIT],
             help="Format of the report: plain (default), json, junit")
+        output_group.add_option(
+            "--json-compact", dest="json_compact",
+            action="store_true", default=False,
+            help="Prints the json report without indentation or spaces.")
         output_group.add_option(
             "-o", "--output", dest="output", action="store",
             default=None,
@@ -704,10 +708,20 @@ class SitePage(UTF8Class):
         else:
             self.erroneous_content = []
 
+        # The messages only depend on the crawl result, which does not change
+        # once the page is created, so they are computed on first use.
+        self._status_message = None
+        self._content_messages = None
+
     def add_sources(self, page_sources):
         self.sources.extend(page_sources)
 
     def get_status_message(self):
+        if self._status_message is None:
+            self._status_message = self._compute_status_message()
+        return self._status_message
+
+    def _compute_status_message(self):
         if self.status:
             if self.status < 400:
                 return self._compute_ok_status(self.status)
@@ -737,13 +751,15 @@ class SitePage(UTF8Class):
     def get_content_messages(self):
         """Gets missing and erroneous content
         """
-        messages = [
-            "missing content: {0}".format(content) for content in
-            self.missing_content] + [
-            "erroneous content: {0}".format(content) for content in
-            self.erroneous_content]
-
-        return messages
+        if self._content_messages is None:
+            self._content_messages = [
+                "missing content: {0}".format(content) for content in
+                self.missing_content] + [
+                "erroneous content: {0}".format(content) for content in
+                self.erroneous_content]
+
+        # Return a copy so callers cannot alter the cached messages.
+        return list(self._content_messages)
 
     def __unicode__(self):
         return "Resource {0} - {1}".format(
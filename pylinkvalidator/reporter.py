@@ -3,34 +3,119 @@ Contains the reporting functions
 """
 from __future__ import unicode_literals, absolute_import, print_function
 
-import codecs
+import io
 import json
 import re
 import smtplib
 import sys
+from traceback import print_exc
 
+from email.header import Header
 from email.mime.text import MIMEText
+from email.utils import formataddr, parseaddr
 
 from junit_xml import TestSuite, TestCase
 
-from pylinkvalidator.compat import StringIO
+from pylinkvalidator.compat import StringIO, get_safe_str, unicode
 from pylinkvalidator.models import (
     FORMAT_JSON,
     FORMAT_JUNIT,
     FORMAT_PLAIN,
     REPORT_TYPE_ALL,
     REPORT_TYPE_ERRORS,
+    SitePage,
 )
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 
 PLAIN_TEXT = "text/plain"
 HTML = "text/html"
 
-WHITESPACES = re.compile(r"\s+")
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+NEWLINES = re.compile(r"\r?\n")
+
+# Maximum length of a line in an 8bit message body (RFC 5322), without CRLF.
+MAX_8BIT_LINE_LENGTH = 998
+
+JSON_ENCODER_OPTIONS = {
+    "sort_keys": True, "indent": 4, "separators": (',', ': ')}
+COMPACT_JSON_ENCODER_OPTIONS = {
+    "sort_keys": True, "separators": (',', ':')}
+
+
+class _URLCache(dict):
+    """Maps url splits to their url so each url is only built once.
+
+    A page is usually the origin of many sources, so the same url split is
+    converted many times while writing a report.
+    """
+
+    def __missing__(self, url_split):
+        url = url_split.geturl()
+        self[url_split] = url
+        return url
+
+
+class ReportEncoder(json.JSONEncoder):
+    """Encodes the json report and the SitePage instances it contains.
+
+    Pages are converted to dicts only when the encoder reaches them, so the
+    report never holds the details of all pages at once.
+    """
+
+    def __init__(self, **kwargs):
+        super(ReportEncoder, self).__init__(**kwargs)
+        self.urls = _URLCache()
+
+    def default(self, o):
+        if isinstance(o, SitePage):
+            return self._get_page_details(o)
+        return super(ReportEncoder, self).default(o)
+
+    def _get_page_details(self, page):
+        urls = self.urls
+        url_split = page.url_split
+        # Sources are PageSource(origin, origin_str, target) tuples: unzip
+        # them in one pass instead of walking the list once per field.
+        if page.sources:
+            origins, origin_strs, targets = zip(*page.sources)
+        else:
+            origins = origin_strs = targets = ()
+        return {
+            'link': urls[url_split],
+            'fragment': url_split.fragment,
+            'hostname': url_split.hostname,
+            'netloc': url_split.netloc,
+            'is_local': page.is_local,
+            'is_html': page.is_html,
+            'is_ok': page.is_ok,
+            'is_timeout': page.is_timeout,
+            'process_time': page.process_time,
+            'response_time': page.response_time,
+            'status': page.status,
+            'path': url_split.path,
+            'port': url_split.port,
+            'query': url_split.query,
+            'scheme': url_split.scheme,
+            'origins': [urls[origin] for origin in origins],
+            'sources': list(origin_strs),
+            'targets': list(targets)
+        }
 
 
 EMAIL_HEADER = "from: {0}\r\nsubject: {1}\r\nto: {2}\r\nmime-version: 1.0\r\n"\
-               "content-type: {3}\r\n\r\n{4}"
+               "content-type: {3}\r\ncontent-transfer-encoding: 8bit\r\n"\
+               "\r\n{4}"
 
 
 def close_quietly(a_file):
@@ -49,7 +134,13 @@ def report(site, config, total_time, logger=None):
     email_file = None
 
     if config.options.output:
-        output_file = codecs.open(config.options.output, "w", "utf-8")
+        # Reports issue many small writes: buffer them before they hit the
+        # file. Newlines are written as is, like the previous codecs writer.
+        # Unlike that writer, the stream only accepts unicode on Python 2:
+        # writers must convert byte strings with compat.unicode.
+        output_file = io.open(
+            config.options.output, "w", encoding="utf-8", newline="",
+            buffering=OUTPUT_BUFFER_SIZE)
         output_files.append(output_file)
 
     if config.options.smtp:
@@ -61,9 +152,10 @@ def report(site, config, total_time, logger=None):
 
     try:
         if config.options.format == FORMAT_PLAIN:
-            _write_plain_text_report(site, config, output_files, total_time)
+            _write_plain_text_report(
+                site, config, output_files, total_time, logger)
         if config.options.format == FORMAT_JSON:
-            _write_json_report(site, config, output_file, total_time)
+            _write_json_report(site, config, output_file, total_time, logger)
         if config.options.format == FORMAT_JUNIT:
             _write_junit_report(site, config, output_file, total_time)
     except Exception:
@@ -77,32 +169,83 @@ def report(site, config, total_time, logger=None):
         send_email(email_file, site, config)
 
 
-def _write_plain_text_report(site, config, output_files, total_time):
+def _log_exception(logger, message):
+    """Logs the current exception, or prints it if there is no logger."""
+    if logger:
+        logger.exception(message)
+    else:
+        print_exc()
+
+
+def _write_plain_text_report(site, config, output_files, total_time,
+                             logger=None):
     if config.options.multi:
-        _write_plain_text_report_multi(site, config, output_files, total_time)
+        _write_plain_text_report_multi(
+            site, config, output_files, total_time, logger)
     else:
-        _write_plain_text_report_single(site, config, output_files, total_time)
+        _write_plain_text_report_single(
+            site, config, output_files, total_time, logger)
+
+
+def _get_start_urls(site):
+    """Returns the comma-separated start urls of the site."""
+    return ",".join(
+        start_url_split.geturl() for start_url_split in site.start_url_splits)
+
+
+def _get_summary(site):
+    """Returns the total number of urls, the total number of errors, the
+    global status and the error summary of the site.
+    """
+    total_urls = len(site.pages)
+    total_errors = len(site.error_pages)
+
+    if not site.is_ok:
+        global_status = "ERROR"
+        error_summary = "with {0} error(s) ".format(total_errors)
+    else:
+        global_status = "SUCCESS"
+        error_summary = ""
+
+    return (total_urls, total_errors, global_status, error_summary)
+
+
+def _select_pages(site, config, multi=False):
+    """Returns the pages to include in the report based on the report type.
+
+    In multi mode, the pages are grouped by start domain.
+    """
+    report_type = config.options.report_type
+    if report_type == REPORT_TYPE_ERRORS:
+        return site.multi_error_pages if multi else site.error_pages
+    elif report_type == REPORT_TYPE_ALL:
+        return site.multi_pages if multi else site.pages
+    else:
+        return {}
 
 
 def _write_junit_report(site, config, output_file, total_time):
     pages = site.pages
     test_cases = []
+    urls = _URLCache()
 
-    for results, resource in pages.items():
-        origins = [source.origin.geturl() for source in resource.sources]
+    for resource in pages.values():
+        url_split = resource.url_split
         if resource.status == 200:
             test_case = TestCase(
-                name=resource.url_split.geturl(),
-                classname=results.hostname,
+                name=urls[url_split],
+                classname=url_split.hostname,
                 elapsed_sec=resource.response_time,
                 stdout=resource.status,
                 status="passed"
                 )
         else:
-            stderr_message = "Link found on:\n{}".format("\n".join(origins))
+            # Origins are only needed to explain failures.
+            stderr_message = "Link found on:\n" + "\n".join(
+                urls[source.origin] for source in resource.sources)
             test_case = TestCase(
-                name=resource.url_split.geturl(),
-                classname=results.hostname,
+                name=urls[url_split],
+                classname=url_split.hostname,
                 elapsed_sec=resource.response_time,
                 stderr=stderr_message,
                 status="failed"
@@ -115,29 +258,19 @@ def _write_junit_report(site, config, output_file, total_time):
                 message=message, failure_type="UnexpectedStatusCode")
         test_cases.append(test_case)
     test_suite = TestSuite("pylinkvalidator test suite", test_cases)
-    output_file.write(TestSuite.to_xml_string([test_suite]))
+    output_file.write(unicode(TestSuite.to_xml_string([test_suite])))
     print_summary(site, config, total_time)
 
 
-def _write_json_report(site, config, output_file, total_time):
-    start_urls = ",".join((start_url_split.geturl() for start_url_split in
-                           site.start_url_splits))
-
-    total_urls = len(site.pages)
-    total_errors = len(site.error_pages)
-
-    if not site.is_ok:
-        global_status = "ERROR"
-        error_summary = "with {0} error(s) ".format(total_errors)
-    else:
-        global_status = "SUCCESS"
-        error_summary = ""
+def _write_json_report(site, config, output_file, total_time, logger=None):
+    (total_urls, total_errors, global_status, error_summary) =\
+        _get_summary(site)
 
     meta = {
         "total_urls": total_urls,
         "total_errors": total_errors,
         "total_time": total_time,
-        "start_urls": start_urls,
+        "start_urls": _get_start_urls(site),
         "global_status": global_status,
         "error_summary": error_summary
     }
@@ -147,60 +280,62 @@ def _write_json_report(site, config, output_file, total_time):
         meta.update({"avg_response_time": avg_response_time})
         meta.update({"avg_process_time": avg_process_time})
     except Exception:
-        from traceback import print_exc
-        print_exc()
+        _log_exception(
+            logger, "An exception occurred while computing average times")
 
-    pages = {}
-
-    if config.options.report_type == REPORT_TYPE_ERRORS:
-        pages = site.error_pages
-    elif config.options.report_type == REPORT_TYPE_ALL:
-        pages = site.pages
-
-    res_pages = []
-
-    for results, resource in pages.items():
-        details = {
-            'link': resource.url_split.geturl(),
-            'fragment': results.fragment,
-            'hostname': results.hostname,
-            'netloc': results.netloc,
-            'is_local': resource.is_local,
-            'is_html': resource.is_html,
-            'is_ok': resource.is_ok,
-            'is_timeout': resource.is_timeout,
-            'process_time': resource.process_time,
-            'response_time': resource.response_time,
-            'status': resource.status,
-            'path': results.path,
-            'port': results.port,
-            'query': results.query,
-            'scheme': results.scheme,
-            'origins': [source.origin.geturl() for source in resource.sources],
-            'sources': [source.origin_str for source in resource.sources],
-            'targets': [source.target for source in resource.sources]
-        }
-        res_pages.append(details)
+    pages = _select_pages(site, config)
 
-    res = {
-        "meta": meta,
-        "pages": res_pages
-    }
-    output_file.write(
-            json.dumps(res, sort_keys=True, indent=4, separators=(',', ': ')))
+    _write_json(
+        meta, list(pages.values()), output_file, config.options.json_compact)
     print_summary(site, config, total_time)
 
 
-def _write_plain_text_report_multi(site, config, output_files, total_time):
-    total_urls = len(site.pages)
-    total_errors = len(site.error_pages)
-
-    if not site.is_ok:
-        global_status = "ERROR"
-        error_summary = "with {0} error(s) ".format(total_errors)
+def _write_json(meta, pages, output_file, compact=False):
+    """Writes the json report to output_file. pages is a list of SitePage
+    instances serialized by ReportEncoder.
+
+    orjson or ujson are used when installed because they are much faster than
+    the json module. The three produce the same document with sorted keys,
+    but the formatting differs: orjson indents with two spaces instead of four
+    and writes non-ascii characters as is, while ujson and json escape them.
+    With the json module, the indented document is streamed chunk by chunk so
+    the whole report is never held in memory as a single string. Streaming
+    always goes through the pure Python encoder, so the compact document is
+    encoded in one shot instead, which uses the C encoder when available.
+    """
+    if compact:
+        encoder = ReportEncoder(**COMPACT_JSON_ENCODER_OPTIONS)
     else:
-        global_status = "SUCCESS"
-        error_summary = ""
+        encoder = ReportEncoder(**JSON_ENCODER_OPTIONS)
+
+    if orjson:
+        option = orjson.OPT_SORT_KEYS
+        if not compact:
+            option |= orjson.OPT_INDENT_2
+        output_file.write(orjson.dumps(
+            {"meta": meta, "pages": pages}, default=encoder.default,
+            option=option).decode("utf-8"))
+    elif ujson:
+        # ujson does not call default when sort_keys is set, so the pages are
+        # converted beforehand.
+        pages = [encoder.default(page) for page in pages]
+        output_file.write(unicode(ujson.dumps(
+            {"meta": meta, "pages": pages}, sort_keys=True,
+            indent=0 if compact else 4, escape_forward_slashes=False)))
+    elif compact:
+        # On Python 2, the encoder returns ascii byte strings that the text
+        # output file does not accept.
+        output_file.write(unicode(
+            encoder.encode({"meta": meta, "pages": pages})))
+    else:
+        for chunk in encoder.iterencode({"meta": meta, "pages": pages}):
+            output_file.write(unicode(chunk))
+
+
+def _write_plain_text_report_multi(site, config, output_files, total_time,
+                                   logger=None):
+    (total_urls, total_errors, global_status, error_summary) =\
+        _get_summary(site)
 
     try:
         avg_response_time = site.get_average_response_time()
@@ -219,38 +354,26 @@ def _write_plain_text_report_multi(site, config, output_files, total_time):
         oprint("  average process time: {0:.2f} seconds".format(
             avg_process_time), files=output_files)
 
-        pages = {}
-
-        if config.options.report_type == REPORT_TYPE_ERRORS:
-            pages = site.multi_error_pages
-        elif config.options.report_type == REPORT_TYPE_ALL:
-            pages = site.multi_pages
+        pages = _select_pages(site, config, multi=True)
 
+        urls = _URLCache()
         for domain, pages_dict in pages.items():
             if pages_dict:
                 oprint(
                     "\n\n  Start Domain: {0}".format(domain),
                     files=output_files)
 
-                _print_details(pages_dict.values(), output_files, config, 4)
+                _print_details(
+                    pages_dict.values(), output_files, config, 4, urls)
     except Exception:
-        from traceback import print_exc
-        print_exc()
-
-
-def _write_plain_text_report_single(site, config, output_files, total_time):
-    start_urls = ",".join((start_url_split.geturl() for start_url_split in
-                           site.start_url_splits))
+        _log_exception(
+            logger, "An exception occurred while writing the report")
 
-    total_urls = len(site.pages)
-    total_errors = len(site.error_pages)
 
-    if not site.is_ok:
-        global_status = "ERROR"
-        error_summary = "with {0} error(s) ".format(total_errors)
-    else:
-        global_status = "SUCCESS"
-        error_summary = ""
+def _write_plain_text_report_single(site, config, output_files, total_time,
+                                    logger=None):
+    (total_urls, total_errors, global_status, error_summary) =\
+        _get_summary(site)
 
     try:
         avg_response_time = site.get_average_response_time()
@@ -267,90 +390,65 @@ def _write_plain_text_report_single(site, config, output_files, total_time):
             avg_process_time), files=output_files)
 
     except Exception:
-        from traceback import print_exc
-        print_exc()
+        _log_exception(
+            logger, "An exception occurred while writing the report summary")
 
-    pages = {}
-
-    if config.options.report_type == REPORT_TYPE_ERRORS:
-        pages = site.error_pages
-    elif config.options.report_type == REPORT_TYPE_ALL:
-        pages = site.pages
+    pages = _select_pages(site, config)
 
     if pages:
-        oprint("\n  Start URL(s): {0}".format(start_urls), files=output_files)
+        oprint("\n  Start URL(s): " + _get_start_urls(site),
+               files=output_files)
         _print_details(pages.values(), output_files, config)
 
 
 def print_summary(site, config, total_time, indent=2):
-    total_urls = len(site.pages)
-    total_errors = len(site.error_pages)
-
-    if not site.is_ok:
-        global_status = "ERROR"
-        error_summary = "with {0} error(s) ".format(total_errors)
-    else:
-        global_status = "SUCCESS"
-        error_summary = ""
+    (total_urls, total_errors, global_status, error_summary) =\
+        _get_summary(site)
 
     print("{0} Crawled {1} urls {2}in {3:.2f} seconds".format(
         global_status, total_urls, error_summary, total_time))
 
-    pages = {}
+    pages = _select_pages(site, config)
 
-    if config.options.report_type == REPORT_TYPE_ERRORS:
-        pages = site.error_pages
-    elif config.options.report_type == REPORT_TYPE_ALL:
-        pages = site.pages
-
-    initial_indent = " " * indent
-    for page in pages.values():
-        print("\n{2}{0}: {1}".format(
-            page.get_status_message(), page.url_split.geturl(),
-            initial_indent))
-        for content_message in page.get_content_messages():
-            print("{1}  {0}".format(content_message, initial_indent))
-        for source in page.sources:
-            print("{1}  from {0} target={2}".format(
-                source.origin.geturl(), initial_indent, source.target))
-            if config.options.show_source:
-                print("{1}    {0}".format(
-                    source.origin_str, initial_indent))
+    _print_details(pages.values(), [sys.stdout], config, indent)
 
 
-def _print_details(page_iterator, output_files, config, indent=2):
+def _print_details(page_iterator, output_files, config, indent=2,
+                   urls=None):
+    if urls is None:
+        urls = _URLCache()
     initial_indent = " " * indent
     for page in page_iterator:
-        oprint("\n{2}{0}: {1}".format(
-            page.get_status_message(), page.url_split.geturl(),
-            initial_indent),
-            files=output_files)
+        # Print each page in one call instead of one call per line.
+        lines = ["\n{2}{0}: {1}".format(
+            page.get_status_message(), urls[page.url_split],
+            initial_indent)]
         for content_message in page.get_content_messages():
-            oprint("{1}  {0}".format(content_message, initial_indent),
-                   files=output_files)
+            lines.append(initial_indent + "  " + content_message)
         for source in page.sources:
-            oprint("{1}  from {0} target={2}".format(
-                source.origin.geturl(), initial_indent, source.target), files=output_files)
+            lines.append("{1}  from {0} target={2}".format(
+                urls[source.origin], initial_indent, source.target))
             if config.options.show_source:
-                oprint("{1}    {0}".format(
-                    source.origin_str, initial_indent),
-                       files=output_files)
+                lines.append("{1}    {0}".format(
+                    source.origin_str, initial_indent))
+        oprint("\n".join(lines), files=output_files)
 
 
 def oprint(message, files):
     """Prints to a sequence of files."""
+    # Build the line once and write it as is to each file.
+    line = message + "\n"
     for file in files:
-        print(message, file=file)
+        file.write(line)
 
 
 def truncate(value, size=72):
     """Truncates a string if its length is higher than size."""
-    value = value.replace("\n", " ").replace("\r", "").replace("\t", " ")
-    value = value.strip()
-    value = WHITESPACES.sub(" ", value)
+    # split() drops leading and trailing whitespaces and collapses the others
+    value = " ".join(value.replace("\r", "").split())
 
     if len(value) > size:
-        value = "{0}...".format(value[:size-3])
+        value = value[:size-3] + "..."
 
     return value
 
@@ -361,9 +459,9 @@ def send_email(email_file, site, config):
         subject = options.subject
     else:
         if site.is_ok:
-            subject = "SUCCESS - {0}".format(site.start_url_splits[0].geturl())
+            subject = "SUCCESS - " + site.start_url_splits[0].geturl()
         else:
-            subject = "ERROR - {0}".format(site.start_url_splits[0].geturl())
+            subject = "ERROR - " + site.start_url_splits[0].geturl()
 
     if options.from_address:
         from_address = options.from_address
@@ -376,12 +474,6 @@ def send_email(email_file, site, config):
 
     addresses = options.address.split(",")
 
-    msg = MIMEText(email_file.getvalue(), 'plain', "UTF-8")
-
-    msg['From'] = from_address
-    msg['To'] = ", ".join(addresses)
-    msg['Subject'] = subject
-
     smtpserver = smtplib.SMTP(options.smtp, options.port)
 
     if options.tls:
@@ -392,6 +484,56 @@ def send_email(email_file, site, config):
     if options.smtp_username and options.smtp_password:
         smtpserver.login(options.smtp_username, options.smtp_password)
 
-    smtpserver.sendmail(from_address, addresses, msg.as_string())
+    body = NEWLINES.sub("\r\n", email_file.getvalue())
+    headers = (
+        _encode_address(from_address), _encode_header(subject),
+        ", ".join(_encode_address(address) for address in addresses))
+
+    smtpserver.ehlo_or_helo_if_needed()
+    if smtpserver.has_extn("8bitmime") and not _has_long_lines(body):
+        # The report is a single plain text part: build the message directly
+        # instead of going through the email package generator. Long encoded
+        # headers are folded with bare newlines, so they also need CRLF.
+        (from_header, subject_header, to_header) = [
+            NEWLINES.sub("\r\n", header) for header in headers]
+        msg = EMAIL_HEADER.format(
+            from_header, subject_header, to_header,
+            PLAIN_TEXT + "; charset=utf-8", body).encode("utf-8")
+        mail_options = ["BODY=8BITMIME"]
+    else:
+        mime_msg = MIMEText(get_safe_str(body), "plain", "utf-8")
+        mime_msg["From"] = headers[0]
+        mime_msg["Subject"] = headers[1]
+        mime_msg["To"] = headers[2]
+        msg = mime_msg.as_string()
+        mail_options = []
+
+    smtpserver.sendmail(from_address, addresses, msg, mail_options)
 
     smtpserver.quit()
+
+
+def _encode_header(value):
+    """Encodes a header value with RFC 2047 if it is not ascii."""
+    try:
+        value.encode("ascii")
+        return value
+    except UnicodeError:
+        return Header(value, "utf-8").encode()
+
+
+def _encode_address(value):
+    """Encodes the display name of an address with RFC 2047 if it is not
+    ascii. The address itself is never encoded.
+    """
+    (name, address) = parseaddr(value)
+    if not name:
+        return value
+    return formataddr((_encode_header(name), address))
+
+
+def _has_long_lines(body):
+    """Returns True if a line of body is too long to be sent as 8bit."""
+    return any(
+        len(line) > MAX_8BIT_LINE_LENGTH for line in
+        body.encode("utf-8").split(b"\r\n"))
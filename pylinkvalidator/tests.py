@@ -4,6 +4,10 @@ Unit and integration tests for pylinkvalidator
 """
 from __future__ import unicode_literals, absolute_import
 
+import codecs
+from email import message_from_string
+from email.header import decode_header
+import json
 import os
 import logging
 import sys
@@ -11,16 +15,19 @@ from tempfile import mkstemp
 import time
 import threading
 import unittest
+from xml.etree import ElementTree
 
 from pylinkvalidator import api
 import pylinkvalidator.compat as compat
+import pylinkvalidator.reporter as reporter
 from pylinkvalidator.compat import (
     SocketServer, SimpleHTTPServer, get_url_open, get_url_request)
 from pylinkvalidator.crawler import (
     open_url, PageCrawler, WORK_DONE, ThreadSiteCrawler, ProcessSiteCrawler,
     get_logger)
 from pylinkvalidator.models import (
-    Config, WorkerInit, WorkerConfig, WorkerInput, PARSER_STDLIB)
+    Config, SitePage, WorkerInit, WorkerConfig, WorkerInput, PARSER_STDLIB)
+from pylinkvalidator.reporter import report
 from pylinkvalidator.urlutil import get_clean_url_split, get_absolute_url_split
 
 
@@ -53,6 +60,28 @@ def start_http_server():
     return (ip, port, httpd, httpd_thread)
 
 
+class FakeSMTP(object):
+    """Replaces smtplib.SMTP and records the messages sent."""
+
+    extensions = ["8bitmime"]
+    sent = []
+
+    def __init__(self, host, port):
+        pass
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return name in self.extensions
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=()):
+        FakeSMTP.sent.append((from_addr, to_addrs, msg, list(mail_options)))
+
+    def quit(self):
+        pass
+
+
 def has_multiprocessing():
     has_multi = False
 
@@ -106,6 +135,37 @@ class ConfigTest(unittest.TestCase):
         self.assertTrue('baz.com' in config.accepted_hosts)
 
 
+class SitePageTest(unittest.TestCase):
+
+    def test_messages(self):
+        page = SitePage(
+            get_clean_url_split("http://www.example.com/"),
+            missing_content=["foo"])
+        self.assertEqual(
+            "error (200) missing content", page.get_status_message())
+        self.assertEqual(
+            ["missing content: foo"], page.get_content_messages())
+
+        page = SitePage(
+            get_clean_url_split("http://www.example.com/"),
+            missing_content=["foo"], erroneous_content=["bar"])
+        self.assertEqual(
+            "error (200) missing and erroneous content",
+            page.get_status_message())
+        # Cached messages are returned on the second call.
+        self.assertEqual(
+            "error (200) missing and erroneous content",
+            page.get_status_message())
+
+        messages = page.get_content_messages()
+        self.assertEqual(
+            ["missing content: foo", "erroneous content: bar"], messages)
+        messages.append("changed by the caller")
+        self.assertEqual(
+            ["missing content: foo", "erroneous content: bar"],
+            page.get_content_messages())
+
+
 class URLUtilTest(unittest.TestCase):
 
     def test_clean_url_split(self):
@@ -148,6 +208,97 @@ class URLUtilTest(unittest.TestCase):
             get_absolute_url_split("../test.html", base_url_split).geturl())
 
 
+class ReporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.smtp = reporter.smtplib.SMTP
+        reporter.smtplib.SMTP = FakeSMTP
+        FakeSMTP.extensions = ["8bitmime"]
+        FakeSMTP.sent = []
+
+    def tearDown(self):
+        reporter.smtplib.SMTP = self.smtp
+
+    def _send_email(self, report_text, other_options=None):
+        options = {
+            "smtp": "localhost", "address": "a@example.com,b@example.com",
+            "from": "links@example.com", "subject": "Rapport é"}
+        if other_options:
+            options.update(other_options)
+        config = Config()
+        config.parse_api_config(["http://www.example.com/"], options)
+        email_file = compat.StringIO()
+        email_file.write(report_text)
+
+        # The site is only used when there is no subject.
+        reporter.send_email(email_file, None, config)
+
+        self.assertEqual(1, len(FakeSMTP.sent))
+        return FakeSMTP.sent[0]
+
+    def test_send_email_8bit(self):
+        (from_address, addresses, msg, mail_options) = self._send_email(
+            "ok (200): é\nfrom a\r\n")
+
+        self.assertEqual("links@example.com", from_address)
+        self.assertEqual(["a@example.com", "b@example.com"], addresses)
+        self.assertEqual(["BODY=8BITMIME"], mail_options)
+        self.assertEqual(
+            "from: links@example.com\r\n"
+            "subject: =?utf-8?q?Rapport_=C3=A9?=\r\n"
+            "to: a@example.com, b@example.com\r\n"
+            "mime-version: 1.0\r\n"
+            "content-type: text/plain; charset=utf-8\r\n"
+            "content-transfer-encoding: 8bit\r\n"
+            "\r\n"
+            "ok (200): é\r\nfrom a\r\n".encode("utf-8"), msg)
+
+    def test_send_email_8bit_long_headers(self):
+        subject = "Vérification des liens de http://www.example.com/ " * 2
+        (_, _, msg, mail_options) = self._send_email(
+            "ok (200)\n",
+            {"subject": subject, "from": "Vérificateur <links@example.com>"})
+
+        self.assertEqual(["BODY=8BITMIME"], mail_options)
+        (headers, body) = msg.split(b"\r\n\r\n", 1)
+        # Folded headers must not contain bare newlines.
+        self.assertFalse(b"\n" in headers.replace(b"\r\n", b""))
+        self.assertTrue(b"\r\n =?utf-8?q?" in headers)
+        self.assertTrue(
+            b"from: =?utf-8?q?V=C3=A9rificateur?= <links@example.com>\r\n"
+            in headers)
+        self.assertTrue(b"to: a@example.com, b@example.com\r\n" in headers)
+
+        message = message_from_string(msg.decode("utf-8"))
+        self.assertEqual(subject, "".join(
+            part.decode(charset or "ascii") if isinstance(part, bytes)
+            else part for (part, charset) in decode_header(
+                message["subject"])))
+
+    def test_send_email_without_8bitmime(self):
+        FakeSMTP.extensions = []
+        (_, _, msg, mail_options) = self._send_email("ok (200): é\n")
+
+        self.assertEqual([], mail_options)
+        message = message_from_string(msg)
+        self.assertEqual("base64", message["Content-Transfer-Encoding"])
+        self.assertEqual("=?utf-8?q?Rapport_=C3=A9?=", message["Subject"])
+        self.assertEqual(
+            "ok (200): é\r\n".encode("utf-8"),
+            message.get_payload(decode=True))
+
+    def test_send_email_long_lines(self):
+        long_line = "x" * 1200
+        (_, _, msg, mail_options) = self._send_email(long_line + "\n")
+
+        self.assertEqual([], mail_options)
+        message = message_from_string(msg)
+        self.assertEqual("base64", message["Content-Transfer-Encoding"])
+        self.assertEqual(
+            (long_line + "\r\n").encode("utf-8"),
+            message.get_payload(decode=True))
+
+
 class CrawlerTest(unittest.TestCase):
 
     @classmethod
@@ -407,6 +558,160 @@ class CrawlerTest(unittest.TestCase):
         self.assertEqual(1, len(site.error_pages))
         os.unlink(temp_file_path)
 
+    def _crawl_for_report(self, other_options, url="/index.html"):
+        sys.argv = ["pylinkvalidator", self.get_url(url)] + other_options
+        config = Config()
+        config.parse_cli_config()
+
+        crawler = ThreadSiteCrawler(config, get_logger())
+        crawler.crawl()
+
+        return (crawler.site, config)
+
+    def _get_report(self, site, config):
+        """Writes the report to a temporary file and returns its content."""
+        (_, temp_file_path) = mkstemp()
+        config.options.output = temp_file_path
+
+        # The summary is also printed on the console.
+        stdout = sys.stdout
+        sys.stdout = compat.StringIO()
+        try:
+            report(site, config, 0)
+        finally:
+            sys.stdout = stdout
+
+        with codecs.open(temp_file_path, "r", "utf-8") as temp_file:
+            content = temp_file.read()
+        os.unlink(temp_file_path)
+
+        return content
+
+    def _get_json_report(self, site, config, orjson, ujson):
+        """Returns the json report written with the given json libraries.
+        """
+        (old_orjson, old_ujson) = (reporter.orjson, reporter.ujson)
+        (reporter.orjson, reporter.ujson) = (orjson, ujson)
+        try:
+            return self._get_report(site, config)
+        finally:
+            (reporter.orjson, reporter.ujson) = (old_orjson, old_ujson)
+
+    def test_plain_text_report(self):
+        (site, config) = self._crawl_for_report(["-E", "all", "-S"])
+        content = self._get_report(site, config)
+
+        self.assertTrue(content.startswith(
+            "ERROR Crawled 11 urls with 1 error(s) in 0.00 seconds\n"))
+        self.assertTrue(
+            "\n  Start URL(s): {0}\n".format(self.get_url("/index.html"))
+            in content)
+        self.assertTrue("\n".join([
+            "",
+            "  ok (200): {0}".format(self.get_url("/a.html")),
+            "    from {0} target=None".format(self.get_url("/index.html")),
+            '      <a href="a.html">Test A</a>',
+            "    from {0} target=None".format(self.get_url("/f.html")),
+            '      <a href="a.html">Nothing</a>',
+            ""]) in content)
+        self.assertTrue("\n".join([
+            "",
+            "  not found (404): {0}".format(self.get_url("/nothing.html")),
+            "    from {0} target=None".format(self.get_url("/f.html")),
+            '      <a href="nothing.html">Nothing</a>',
+            ""]) in content)
+
+    def test_junit_report(self):
+        (site, config) = self._crawl_for_report(["-f", "junit"])
+        content = self._get_report(site, config)
+
+        test_cases = dict(
+            (test_case.get("name"), test_case) for test_case in
+            ElementTree.fromstring(content.encode("utf-8")).findall(
+                ".//testcase"))
+        self.assertEqual(11, len(test_cases))
+
+        test_case = test_cases[self.get_url("/nothing.html")]
+        self.assertEqual("failed", test_case.get("status"))
+        self.assertEqual(
+            "Expected 200 OK but got 404",
+            test_case.find("failure").get("message"))
+        self.assertEqual(
+            "Link found on:\n" + self.get_url("/f.html"),
+            test_case.find("system-err").text)
+
+        test_case = test_cases[self.get_url("/a.html")]
+        self.assertEqual("passed", test_case.get("status"))
+        self.assertEqual(None, test_case.find("system-err"))
+
+    def test_json_compact_report(self):
+        (site, config) = self._crawl_for_report(
+            ["-f", "json", "--json-compact"])
+        content = self._get_report(site, config)
+
+        self.assertTrue("\n" not in content)
+        result = json.loads(content)
+        self.assertEqual(11, result["meta"]["total_urls"])
+        self.assertEqual(1, len(result["pages"]))
+
+    def _assert_json_page(self, pages):
+        """Checks the details of a.html in the pages of a json report."""
+        page = dict([page for page in pages
+                     if page["link"] == self.get_url("/a.html")][0])
+
+        for key in ("process_time", "response_time"):
+            self.assertTrue(isinstance(page.pop(key), float))
+        self.assertEqual({
+            "link": self.get_url("/a.html"),
+            "fragment": "",
+            "hostname": self.ip,
+            "netloc": "{0}:{1}".format(self.ip, self.port),
+            "is_local": True,
+            "is_html": True,
+            "is_ok": True,
+            "is_timeout": False,
+            "status": 200,
+            "path": "/a.html",
+            "port": self.port,
+            "query": "",
+            "scheme": "http",
+            "origins": [
+                self.get_url("/index.html"), self.get_url("/f.html")],
+            "sources": [
+                "<a href=\"a.html\">Test A</a>",
+                "<a href=\"a.html\">Nothing</a>"],
+            "targets": [None, None]
+        }, page)
+
+    def test_json_report_backends(self):
+        (site, config) = self._crawl_for_report(["-f", "json", "-E", "all"])
+
+        for compact in (False, True):
+            config.options.json_compact = compact
+            contents = [
+                self._get_json_report(
+                    site, config, reporter.orjson, reporter.ujson),
+                self._get_json_report(site, config, None, reporter.ujson),
+                self._get_json_report(site, config, None, None)]
+
+            results = [json.loads(content) for content in contents]
+            self.assertEqual(11, len(results[0]["pages"]))
+            self._assert_json_page(results[0]["pages"])
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[0], results[2])
+            for content in contents:
+                self.assertEqual(compact, "\n" not in content)
+
+    def test_json_report_stdlib(self):
+        (site, config) = self._crawl_for_report(
+            ["-f", "json", "-E", "all", "--prefer-server-encoding"],
+            "/é.html")
+        content = self._get_json_report(site, config, None, None)
+
+        result = json.loads(content)
+        self.assertEqual(2, result["meta"]["total_urls"])
+        self.assertEqual(2, len(result["pages"]))
+
     def test_depth_0(self):
         site = self._run_crawler_plain(
             ThreadSiteCrawler, ["--depth", "0"], "/depth/root.html")